@@ -3,11 +3,24 @@
 # All it does is change the name of the commit's author.
 # It could do other things, including modifying the
 # channels list
-# 
+#
+# It works all three ways irkerhook.py can run a filter:
+# as filtercmd, given the metadata as its argument; as filtercmd
+# with filtermode=coprocess, reading a line of JSON metadata per
+# commit and answering each with one line; and as filtermodule,
+# loaded in-process and called through filter().
+#
 import sys, json
-metadata = json.loads(sys.argv[1])
 
-metadata['author'] = "The Great and Powerful Oz"
+def filter(metadata):
+    metadata['author'] = "The Great and Powerful Oz"
+    return metadata
 
-print json.dumps(metadata)
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        print(json.dumps(filter(json.loads(sys.argv[1]))))
+    else:
+        for line in sys.stdin:
+            print(json.dumps(filter(json.loads(line))))
+            sys.stdout.flush()
 # end
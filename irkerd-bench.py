@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+"""
+irkerd-bench.py - throughput, latency and soak testing for irkerd
+
+Starts a set of fake IRC servers on localhost, launches an irkerd
+instance, fires JSON requests at its listener and reports delivered
+messages per second, enqueue-to-delivery latency percentiles, and
+irkerd's thread count and resident set size over the run.
+
+usage: irkerd-bench.py [options] [-- irkerd-options...]
+
+Everything after a bare -- is passed to irkerd.  irkerd listens on its
+fixed port (6659), so no other instance may be running.  Its default
+flood control allows about one line a second per connection, so for
+raw throughput numbers you will want something like "-- -b 1000 -r 1000".
+
+With --parse, no servers or irkerd process are started; instead a
+canned burst of NAMES and MOTD replies, like a busy network sends on
+connect, is fed through irkerd's line splitter and message parser in
+process, and the rate in lines per second is reported.
+
+Examples:
+    irkerd-bench.py --servers 4 --channels 10 --rate 50 --duration 30
+    irkerd-bench.py --soak --duration 3600 --rate 5 -- -E asyncio
+    irkerd-bench.py --parse --read-size 512
+
+Probably only of interest to irker developers.
+"""
+# SPDX-License-Identifier: BSD-2-Clause
+
+# pylint: disable=invalid-name,missing-function-docstring,missing-class-docstring,consider-using-f-string,too-many-instance-attributes
+
+import argparse
+import asyncio
+import importlib.machinery
+import importlib.util
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+IRKERD_PORT = 6659
+
+# Run irkerd with tracemalloc on, snapshotting it in the background.
+# argv: report-path interval irkerd-path irkerd-args...
+TRACEMALLOC_BOOTSTRAP = '''
+import runpy, sys, threading, time, tracemalloc
+tracemalloc.start()
+def watch(path, interval):
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    # Let startup allocations settle before taking the baseline.
+    time.sleep(interval)
+    base = tracemalloc.take_snapshot().filter_traces(ignore)
+    start = time.time()
+    while True:
+        time.sleep(interval)
+        snap = tracemalloc.take_snapshot().filter_traces(ignore)
+        with open(path, "a") as fp:
+            fp.write("T %.1f %d\\n" % (time.time() - start,
+                                      tracemalloc.get_traced_memory()[0]))
+            for stat in snap.compare_to(base, "lineno")[:10]:
+                fp.write("S %s\\n" % stat)
+threading.Thread(target=watch, args=(sys.argv[1], float(sys.argv[2])),
+                 daemon=True).start()
+script = sys.argv[3]
+sys.argv = sys.argv[3:]
+runpy.run_path(script, run_name="__main__")
+'''
+
+class Recorder:
+    "Collect deliveries as the fake servers see them."
+    def __init__(self):
+        self.latencies = []
+        self.lines = 0
+        self.first = None
+        self.last = None
+        self.joins = 0
+        self.kicks = 0
+        self.connections = 0
+
+    def record(self, text):
+        now = time.time()
+        self.lines += 1
+        fields = text.split()
+        if len(fields) >= 3 and fields[0] == "bench":
+            self.latencies.append(now - float(fields[2]))
+            if self.first is None:
+                self.first = now
+            self.last = now
+
+class FakeServer:
+    "A scriptable stand-in for an IRC server."
+    def __init__(self, port, options, recorder):
+        self.port = port
+        self.options = options
+        self.recorder = recorder
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.client, "127.0.0.1", self.port)
+
+    async def pinger(self, writer):
+        while True:
+            await asyncio.sleep(self.options.ping_interval)
+            writer.write(b"PING :fake.bench\r\n")
+
+    async def client(self, reader, writer):
+        # pylint: disable=too-many-branches
+        opts = self.options
+        nick = "*"
+        counts = {}
+        self.recorder.connections += 1
+        pinger = None
+        if opts.ping_interval:
+            pinger = asyncio.ensure_future(self.pinger(writer))
+        try:
+            while True:
+                raw = await reader.readline()
+                if not raw:
+                    break
+                if opts.delay:
+                    await asyncio.sleep(opts.delay)
+                line = raw.decode("utf-8", "replace").rstrip("\r\n")
+                (command, _, rest) = line.partition(" ")
+                command = command.upper()
+                if command == "NICK":
+                    nick = rest.strip()
+                elif command == "USER":
+                    features = "CHANLIMIT=#:%d" % opts.chanlimit
+                    if opts.targmax:
+                        features += " TARGMAX=PRIVMSG:%d" % opts.targmax
+                    writer.write((":fake.bench 001 %s :Welcome\r\n"
+                                  ":fake.bench 005 %s %s :are supported\r\n"
+                                  % (nick, nick, features)).encode("utf-8"))
+                elif command == "JOIN":
+                    for channel in rest.split(" ")[0].split(","):
+                        self.recorder.joins += 1
+                        writer.write((":%s!irker@localhost JOIN %s\r\n"
+                                      % (nick, channel)).encode("utf-8"))
+                elif command == "PRIVMSG":
+                    (targets, _, text) = rest.partition(" :")
+                    for target in targets.split(","):
+                        self.recorder.record(text)
+                        counts[target] = counts.get(target, 0) + 1
+                        if opts.kick_every \
+                               and counts[target] % opts.kick_every == 0:
+                            self.recorder.kicks += 1
+                            writer.write((":op!op@localhost KICK %s %s :bench\r\n"
+                                          % (target, nick)).encode("utf-8"))
+                elif command == "QUIT":
+                    break
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            # Connection dropped, or the run is over
+            pass
+        finally:
+            if pinger:
+                pinger.cancel()
+            writer.close()
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def process_stats(pid):
+    "Return (threads, RSS in kB) for a process, from /proc."
+    threads = rss = 0
+    try:
+        with open("/proc/%d/status" % pid) as fp:
+            for line in fp:
+                if line.startswith("Threads:"):
+                    threads = int(line.split()[1])
+                elif line.startswith("VmRSS:"):
+                    rss = int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return (threads, rss)
+
+def wait_for_listener(proc, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            sys.stderr.write("irkerd-bench: irkerd exited early\n")
+            raise SystemExit(1)
+        try:
+            socket.create_connection(("127.0.0.1", IRKERD_PORT), 0.5).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    sys.stderr.write("irkerd-bench: irkerd never started listening\n")
+    raise SystemExit(1)
+
+async def drive(options, targets, samples, proc):
+    "Send requests at the configured rate, sampling irkerd as we go."
+    if options.transport == "tcp":
+        (_, writer) = await asyncio.open_connection("127.0.0.1", IRKERD_PORT)
+        send = lambda data: writer.write(data)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        send = lambda data: sock.sendto(data, ("127.0.0.1", IRKERD_PORT))
+    start = time.time()
+    next_sample = start
+    sent = 0
+    while True:
+        now = time.time()
+        if now >= next_sample:
+            samples.append((now - start,) + process_stats(proc.pid))
+            next_sample += options.sample
+        if now - start >= options.duration:
+            break
+        due = int((now - start) * options.rate)
+        while sent < due:
+            server = random.choice(targets)
+            to = random.sample(server, min(options.fanout, len(server)))
+            request = {"to": to, "privmsg": "bench %d %.6f" % (sent, time.time())}
+            send(json.dumps(request).encode("utf-8") + b"\n")
+            sent += 1
+        if options.transport == "tcp":
+            await writer.drain()
+        await asyncio.sleep(min(0.01, 1.0 / options.rate))
+    if options.transport == "tcp":
+        writer.close()
+    return (sent, start)
+
+async def run(options, irkerd_args):
+    recorder = Recorder()
+    servers = [FakeServer(options.base_port + i, options, recorder)
+               for i in range(options.servers)]
+    for server in servers:
+        await server.start()
+    targets = [["irc://127.0.0.1:%d/bench%d" % (server.port, c)
+                for c in range(options.channels)] for server in servers]
+
+    report = None
+    command = [sys.executable, options.irkerd] + irkerd_args
+    if options.soak:
+        report = os.path.join(tempfile.gettempdir(),
+                              "irkerd-bench-%d.tracemalloc" % os.getpid())
+        command = [sys.executable, "-c", TRACEMALLOC_BOOTSTRAP, report,
+                   str(options.sample), options.irkerd] + irkerd_args
+    proc = subprocess.Popen(command)
+    samples = []
+    try:
+        await asyncio.get_event_loop().run_in_executor(
+            None, wait_for_listener, proc)
+        (sent, start) = await drive(options, targets, samples, proc)
+        expected = sent * min(options.fanout, options.channels)
+        deadline = time.time() + options.drain
+        while len(recorder.latencies) < expected and time.time() < deadline:
+            await asyncio.sleep(0.1)
+        samples.append((time.time() - start,) + process_stats(proc.pid))
+    except BaseException:
+        if report and os.path.exists(report):
+            os.remove(report)
+        raise
+    finally:
+        proc.terminate()
+        proc.wait()
+        for server in servers:
+            server.server.close()
+
+    delivered = len(recorder.latencies)
+    span = (recorder.last - recorder.first) if delivered > 1 else 0
+    print("requests sent:        %d (%s)" % (sent, options.transport))
+    print("messages delivered:   %d of %d" % (delivered, expected))
+    print("delivery rate:        %.1f msgs/sec" % (delivered / span if span else 0))
+    print("latency p50:          %.3f s" % percentile(recorder.latencies, 0.50))
+    print("latency p99:          %.3f s" % percentile(recorder.latencies, 0.99))
+    print("latency max:          %.3f s" % percentile(recorder.latencies, 1.0))
+    print("server connections:   %d" % recorder.connections)
+    print("joins / kicks:        %d / %d" % (recorder.joins, recorder.kicks))
+    print("")
+    print("%8s %8s %10s" % ("seconds", "threads", "RSS kB"))
+    for (elapsed, threads, rss) in samples:
+        print("%8.1f %8d %10d" % (elapsed, threads, rss))
+    if report:
+        leak_report(report, options.leak_threshold)
+
+def leak_report(path, threshold):
+    "Summarize tracemalloc growth; flag steady growth as a probable leak."
+    points = []
+    stats = []
+    try:
+        with open(path) as fp:
+            for line in fp:
+                if line.startswith("T "):
+                    (_, elapsed, traced) = line.split()
+                    points.append((float(elapsed), int(traced)))
+                    stats = []
+                elif line.startswith("S "):
+                    stats.append(line[2:].rstrip())
+    except IOError:
+        print("\nno tracemalloc data collected")
+        return
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    if len(points) < 2:
+        print("\ntoo few tracemalloc samples for leak detection")
+        return
+    # Least-squares slope of traced memory over time
+    n = len(points)
+    mean_t = sum(t for (t, _) in points) / n
+    mean_m = sum(m for (_, m) in points) / n
+    var = sum((t - mean_t) ** 2 for (t, _) in points)
+    slope = sum((t - mean_t) * (m - mean_m) for (t, m) in points) / var
+    per_minute = slope * 60 / 1024
+    print("")
+    print("traced memory:        %d kB -> %d kB" % (
+        points[0][1] // 1024, points[-1][1] // 1024))
+    print("growth trend:         %.1f kB/minute" % per_minute)
+    if per_minute > threshold:
+        print("PROBABLE LEAK: growth exceeds %.1f kB/minute; largest growth:"
+              % threshold)
+        for stat in stats:
+            print("    " + stat)
+
+class Feed:
+    "Stands in for a server socket, handing out canned reads."
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+
+    def recv(self, _size):
+        return next(self.chunks, b"")
+
+def parse_bench(options):
+    loader = importlib.machinery.SourceFileLoader("irkerd", options.irkerd)
+    irkerd = importlib.util.module_from_spec(
+        importlib.util.spec_from_loader("irkerd", loader))
+    loader.exec_module(irkerd)
+    lines = []
+    for i in range(options.parse_lines // 2):
+        nicks = " ".join("@user%d" % (i * 40 + j) for j in range(40))
+        lines.append(":irc.bench 353 irker = #busy%d :%s" % (i % 16, nicks))
+        lines.append(":irc.bench 372 irker :- " + "message of the day " * 4)
+    data = ("\r\n".join(lines) + "\r\n").encode("utf-8")
+    chunks = [data[i:i + options.read_size]
+              for i in range(0, len(data), options.read_size)]
+    connection = irkerd.IRCClient().newserver()
+    connection.buffer = irkerd.LineBufferedStream()
+    connection.event_handlers = {}
+    connection.real_server_name = ""
+    connection.socket = Feed(chunks)
+    start = time.perf_counter()
+    for _ in chunks:
+        connection.consume()
+    elapsed = time.perf_counter() - start
+    print("%d lines (%.1f MB) in %d reads of %d bytes: %.3fs" % (
+        len(lines), len(data) / 1e6, len(chunks), options.read_size, elapsed))
+    print("%.0f lines/s, %.1f MB/s" % (len(lines) / elapsed,
+                                       len(data) / 1e6 / elapsed))
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        usage="%(prog)s [options] [-- irkerd-options...]")
+    parser.add_argument("--irkerd", default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "irkerd"),
+                        help="irkerd to test (default: the one alongside)")
+    parser.add_argument("--servers", type=int, default=1,
+                        help="fake IRC servers to run (default: 1)")
+    parser.add_argument("--channels", type=int, default=4,
+                        help="channels per server (default: 4)")
+    parser.add_argument("--fanout", type=int, default=1,
+                        help="channels addressed by each request (default: 1)")
+    parser.add_argument("--rate", type=float, default=10.0,
+                        help="requests per second (default: 10)")
+    parser.add_argument("--duration", type=float, default=10.0,
+                        help="seconds to send for (default: 10)")
+    parser.add_argument("--drain", type=float, default=60.0,
+                        help="seconds to wait for stragglers (default: 60)")
+    parser.add_argument("--transport", choices=["tcp", "udp"], default="tcp",
+                        help="irkerd listener to use (default: tcp)")
+    parser.add_argument("--base-port", type=int, default=16667,
+                        help="port of the first fake server (default: 16667)")
+    parser.add_argument("--chanlimit", type=int, default=18,
+                        help="CHANLIMIT the fake servers advertise (default: 18)")
+    parser.add_argument("--targmax", type=int, default=0,
+                        help="PRIVMSG TARGMAX to advertise (default: none)")
+    parser.add_argument("--delay", type=float, default=0.0,
+                        help="server delay before handling each line")
+    parser.add_argument("--kick-every", type=int, default=0,
+                        help="kick irkerd after every N messages to a channel")
+    parser.add_argument("--ping-interval", type=float, default=0.0,
+                        help="seconds between server PINGs (default: never)")
+    parser.add_argument("--sample", type=float, default=1.0,
+                        help="seconds between thread/RSS samples (default: 1)")
+    parser.add_argument("--soak", action="store_true",
+                        help="run irkerd under tracemalloc and look for leaks")
+    parser.add_argument("--leak-threshold", type=float, default=64.0,
+                        help="kB/minute of growth to call a leak (default: 64)")
+    parser.add_argument("--parse", action="store_true",
+                        help="time irkerd's reader on a canned burst instead")
+    parser.add_argument("--parse-lines", type=int, default=200000,
+                        help="lines in the --parse burst (default: 200000)")
+    parser.add_argument("--read-size", type=int, default=16384,
+                        help="bytes per read in --parse mode (default: 16384)")
+    argv = sys.argv[1:]
+    irkerd_args = []
+    if "--" in argv:
+        irkerd_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+    options = parser.parse_args(argv)
+    if not any(arg in ("-H6", "--host6") for arg in irkerd_args):
+        # irkerd's IPv6 listener defaults to "localhost", which often
+        # resolves only to an IPv4 address.
+        irkerd_args += ["-H6", "::1"]
+    return (options, irkerd_args)
+
+if __name__ == "__main__":
+    (options, irkerd_args) = parse_args()
+    if options.parse:
+        parse_bench(options)
+        sys.exit(0)
+    try:
+        asyncio.run(run(options, irkerd_args))
+    except KeyboardInterrupt:
+        pass
+
+# end
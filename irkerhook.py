@@ -40,6 +40,16 @@ urlprefixmap = {
 # By default, ship to our #oftc-status channel
 default_channels = u"ircs://irc.oftc.net/#oftc-status"
 
+# Seconds to wait on the web view or tinyifier before giving up on a
+# URL, and how many commits' URLs may be looked up at once.
+URL_TIMEOUT = 10
+URL_WORKERS = 8
+
+# Resolved URLs are remembered on disk for this many seconds, so that
+# re-pushes and mirrors of the same commits don't go back to the network.
+URL_CACHE_TTL = 7 * 24 * 60 * 60
+URL_CACHE_MAX = 10000
+
 #
 # No user-serviceable parts below this line:
 #
@@ -47,7 +57,12 @@ default_channels = u"ircs://irc.oftc.net/#oftc-status"
 version = "2.21"
 
 # pylint: disable=multiple-imports,wrong-import-position
-import os, sys, socket, subprocess, locale, datetime, re
+import os, sys, socket, subprocess, locale, datetime, re, threading, time
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
 
 try:
     from shlex import quote as shellquote
@@ -108,46 +123,114 @@ class Commit:
             # Not really needed, but maybe useful for debugging
             self.__str__ = lambda x: x.__unicode__().encode('utf-8')
 
-    def __str__(self):
-        "Produce a notification string from this commit."
+    def webview(self):
+        "Return the web view URL of this commit, or None."
         # pylint: disable=no-member
-        if not self.urlprefix:
+        if not self.urlprefix or self.urlprefix.lower() == "none":
+            return None
+        urlprefix = urlprefixmap.get(self.urlprefix, self.urlprefix)
+        return (urlprefix % self.__dict__) + self.commit
+
+    def resolve_url(self, cache=None):
+        "Set the URL to announce: the web view, tinyified if possible."
+        webview = self.webview()
+        if webview is None:
             self.url = ""
-        else:
-            # pylint: disable=no-member
-            urlprefix = urlprefixmap.get(self.urlprefix, self.urlprefix)
-            webview = (urlprefix % self.__dict__) + self.commit
-            try:
-                # See it the url is accessible
-                res = urlopen(webview)
-                if self.tinyifier and self.tinyifier.lower() != "none":
+            return
+        # pylint: disable=no-member
+        tinyify = self.tinyifier and self.tinyifier.lower() != "none"
+        key = webview + (" " + self.tinyifier if tinyify else "")
+        if cache is not None:
+            self.url = cache.get(key)
+            if self.url is not None:
+                return
+        try:
+            # See it the url is accessible
+            urlopen(webview, timeout=URL_TIMEOUT).close()
+            if tinyify:
+                try:
+                    # Didn't get a retrieval error on the web
+                    # view, so try to tinyify a reference to it.
+                    self.url = urlopen(self.tinyifier + webview,
+                                       timeout=URL_TIMEOUT).read()
                     try:
-                        # Didn't get a retrieval error on the web
-                        # view, so try to tinyify a reference to it.
-                        self.url = urlopen(self.tinyifier + webview).read()
-                        try:
-                            self.url = self.url.decode('UTF-8')
-                        except UnicodeError:
-                            pass
-                    except IOError:
-                        self.url = webview
-                else:
-                    self.url = webview
-            except HTTPError as e:
-                if e.code == 401:
-                    # Authentication error, so we assume the view is valid
+                        self.url = self.url.decode('UTF-8')
+                    except UnicodeError:
+                        pass
+                except IOError:
                     self.url = webview
-                else:
-                    self.url = ""
-            except IOError:
+            else:
+                self.url = webview
+        except HTTPError as e:
+            if e.code == 401:
+                # Authentication error, so we assume the view is valid
+                self.url = webview
+            else:
                 self.url = ""
+        except IOError:
+            self.url = ""
+        # Failures aren't remembered; the web view may be back next time.
+        if cache is not None and self.url:
+            cache.put(key, self.url)
+
+    def __str__(self):
+        "Produce a notification string from this commit."
+        if self.url is None:
+            self.resolve_url()
         # pylint: disable=no-member
         res = self.template % self.__dict__
         return string_type(res, 'UTF-8') if not isinstance(res, string_type) else res
 
+class URLCache:
+    "Resolved commit URLs, kept on disk between hook runs."
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.dirty = False
+        try:
+            with open(path, "rb") as fp:
+                self.entries = json.loads(fp.read().decode("utf-8"))
+        except (IOError, OSError, ValueError):
+            pass
+    def get(self, key):
+        "Return the URL remembered for a key, or None."
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry and entry[1] > time.time():
+            return entry[0]
+        return None
+    def put(self, key, url):
+        with self.lock:
+            self.entries[key] = [url, time.time() + URL_CACHE_TTL]
+            self.dirty = True
+    def save(self):
+        "Write back the cache, less expired entries, if anything changed."
+        if not self.dirty:
+            return
+        now = time.time()
+        live = sorted((x for x in self.entries.items() if x[1][1] > now),
+                      key=lambda x: x[1][1])[-URL_CACHE_MAX:]
+        # Written aside and renamed, so concurrent hooks never see
+        # half a file; the last one to finish wins.
+        temp = "%s.%d" % (self.path, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with open(temp, "wb") as fp:
+                fp.write(json.dumps(dict(live)).encode("utf-8"))
+            os.rename(temp, self.path)
+        except (IOError, OSError):
+            # It's only a cache, and the hook's output goes back to
+            # whoever pushed; a read-only home is no news to them.
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+
 class GenericExtractor:
     "Generic class for encapsulating data from a VCS."
-    booleans = ["tcp"]
+    booleans = ["tcp", "batch"]
     numerics = ["maxchannels"]
     strings = ["email"]
     def __init__(self, arguments):
@@ -157,6 +240,7 @@ class GenericExtractor:
         # These aren't really repo data but they belong here anyway...
         self.email = None
         self.tcp = True
+        self.batch = False
         self.tinyifier = default_tinyifier
         self.server = None
         self.channels = None
@@ -166,6 +250,11 @@ class GenericExtractor:
         self.host = socket.getfqdn()
         self.cialike = None
         self.filtercmd = None
+        self.filtermode = "command"
+        self.filtermodule = None
+        self.urlcache = os.path.join(
+            os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+            "irker", "urls.json")
         # Color highlighting is disabled by default.
         self.color = None
         self.bold = self.green = self.blue = self.yellow = self.red = ""
@@ -273,26 +362,30 @@ class GitExtractor(GenericExtractor):
                has(dirname, ["HEAD", "refs", "objects"])
     def __init__(self, arguments):
         GenericExtractor.__init__(self, arguments)
-        # Get all global config variables
-        self.project = do("git config --get irker.project")
-        self.repo = do("git config --get irker.repo")
-        self.server = do("git config --get irker.server")
-        self.channels = do("git config --get irker.channels")
-        self.email = do("git config --get irker.email")
-        self.tcp = do("git config --bool --get irker.tcp")
-        self.template = do("git config --get irker.template") or u'%(bold)s%(project)s:%(reset)s %(green)s%(author)s%(reset)s %(repo)s:%(yellow)s%(branch)s%(reset)s * %(bold)s%(rev)s%(reset)s / %(bold)s%(files)s%(reset)s: %(logmsg)s %(brown)s%(url)s%(reset)s'
-        self.tinyifier = do("git config --get irker.tinyifier") or default_tinyifier
-        self.color = do("git config --get irker.color") or u"mIRC"
-        self.urlprefix = do("git config --get irker.urlprefix") or u"gitweb"
-        self.cialike = do("git config --get irker.cialike")
-        self.filtercmd = do("git config --get irker.filtercmd")
+        # Get all global config variables, in one go
+        config = self.config()
+        self.project = config.get("irker.project", "")
+        self.repo = config.get("irker.repo", "")
+        self.server = config.get("irker.server", "")
+        self.channels = config.get("irker.channels", "")
+        self.email = config.get("irker.email", "")
+        self.tcp = config.get("irker.tcp", "")
+        self.batch = config.get("irker.batch", "")
+        self.template = config.get("irker.template") or u'%(bold)s%(project)s:%(reset)s %(green)s%(author)s%(reset)s %(repo)s:%(yellow)s%(branch)s%(reset)s * %(bold)s%(rev)s%(reset)s / %(bold)s%(files)s%(reset)s: %(logmsg)s %(brown)s%(url)s%(reset)s'
+        self.tinyifier = config.get("irker.tinyifier") or default_tinyifier
+        self.color = config.get("irker.color") or u"mIRC"
+        self.urlprefix = config.get("irker.urlprefix") or u"gitweb"
+        self.cialike = config.get("irker.cialike", "")
+        self.filtercmd = config.get("irker.filtercmd", "")
+        self.filtermode = config.get("irker.filtermode") or self.filtermode
+        self.filtermodule = config.get("irker.filtermodule", "")
+        self.urlcache = config.get("irker.urlcache") or self.urlcache
         # These are git-specific
         self.refname = do("git symbolic-ref HEAD 2>/dev/null")
-        self.revformat = do("git config --get irker.revformat")
+        self.revformat = config.get("irker.revformat", "")
         # The project variable defaults to the name of the repository toplevel.
         if not self.project:
-            bare = do("git config --bool --get core.bare")
-            if bare.lower() == "true":
+            if config.get("core.bare") == "true":
                 keyfile = "HEAD"
             else:
                 keyfile = ".git/HEAD"
@@ -309,10 +402,108 @@ class GitExtractor(GenericExtractor):
                 here = os.path.dirname(here)
         # Get overrides
         self.do_overrides()
+    @staticmethod
+    def config():
+        "Return the irker configuration variables, and core.bare."
+        # Boolean variables are normalized the way git config --bool would.
+        config = {}
+        for entry in do("git config -z --get-regexp '^(irker\\.|core\\.bare$)'").split("\0"):
+            (key, newline, value) = entry.partition("\n")
+            if key in ("irker.tcp", "irker.batch", "core.bare"):
+                if not newline or value.lower() in ("true", "yes", "on", "1"):
+                    value = "true"
+                elif value.lower() in ("false", "no", "off", "0", ""):
+                    value = "false"
+            if key:
+                config[key] = value
+        return config
     # pylint: disable=no-self-use
     def head(self):
         "Return a symbolic reference to the tip commit of the current branch."
         return "HEAD"
+    def commits(self, commit_ids):
+        "Make Commit objects for a batch of commit IDs with a few git runs."
+        unique = []
+        for commit_id in commit_ids:
+            if commit_id not in unique:
+                unique.append(commit_id)
+        try:
+            with open(os.devnull, "wb") as devnull:
+                hashes = subprocess.check_output(
+                    ["git", "rev-parse"] + [x + "^{commit}" for x in unique],
+                    stderr=devnull, universal_newlines=True).split()
+        except (OSError, subprocess.CalledProcessError):
+            hashes = []
+        if len(hashes) != len(unique):
+            # Something didn't resolve; leave it to the one-at-a-time path.
+            for commit_id in commit_ids:
+                yield self.commit_factory(commit_id)
+            return
+        resolved = dict(zip(unique, hashes))
+        descriptions = {}
+        if self.revformat == 'describe':
+            # --always, so that one undescribable commit can't fail
+            # the lot; those come back abbreviated, and are caught below.
+            descriptions = dict(zip(hashes, do("git describe --always %s 2>/dev/null" % " ".join(hashes)).split("\n")))
+        records = self.log(hashes)
+        seen = {}
+        for commit_id in commit_ids:
+            full = resolved[commit_id]
+            while full not in seen:
+                record = next(records, None)
+                if record is None:
+                    break
+                seen[record[0]] = record
+            if full in seen:
+                yield self.make_commit(commit_id, seen[full], descriptions.get(full))
+            else:
+                yield self.commit_factory(commit_id)
+    @staticmethod
+    def log(hashes):
+        "Generate [hash, abbrev, name, mail, subject, dates..., files] per commit."
+        # One git log run for the lot, parsed as it streams in.  Root
+        # commits get no file list, as under git diff-tree.
+        proc = subprocess.Popen(
+            ["git", "-c", "log.showRoot=false", "log", "--no-walk=unsorted",
+             "--stdin", "--name-only",
+             "--format=%x1e%H%x1f%h%x1f%an%x1f%ae%x1f%s%x1f%ai%x1f%ci"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            universal_newlines=True)
+        proc.stdin.write("\n".join(hashes) + "\n")
+        proc.stdin.close()
+        record = []
+        for line in proc.stdout:
+            line = line.rstrip("\n")
+            if line.startswith("\x1e"):
+                if record:
+                    yield record
+                record = line[1:].split("\x1f") + [[]]
+            elif line and record:
+                record[-1].append(line)
+        if record:
+            yield record
+        proc.wait()
+    def make_commit(self, commit_id, record, description):
+        "Make a Commit object from a record of the bulk log query."
+        (_, abbrev, author_name, mail, logmsg, author_date, commit_date, files) = record
+        commit = Commit(self, commit_id)
+        commit.branch = re.sub(r"^refs/[^/]*/", "", self.refname)
+        # Same choices as commit_factory(), from the fetched fields
+        if self.revformat == 'raw':
+            commit.rev = commit.commit
+        elif self.revformat == 'describe' and description != abbrev:
+            commit.rev = description or ''
+        else:
+            commit.rev = ''
+        if not commit.rev:
+            commit.rev = abbrev
+            if self.urlprefix in ('gitweb', 'cgit'):
+                commit.commit = commit.rev
+        commit.files = " ".join(files)
+        commit.author_name, commit.mail, commit.logmsg = author_name, mail, logmsg
+        commit.author = commit.author_name
+        commit.author_date, commit.commit_date = author_date, commit_date
+        return commit
     def commit_factory(self, commit_id):
         "Make a Commit object holding data for a specified commit ID."
         commit = Commit(self, commit_id)
@@ -374,11 +565,17 @@ class SvnExtractor(GenericExtractor):
         commit = Commit(self, commit_id)
         commit.branch = ""
         commit.rev = "r%s" % self.id
-        commit.author = self.svnlook("author")
-        commit.commit_date = self.svnlook("date").partition('(')[0]
+        # svnlook info gives author, date, log size and log in one run.
+        (author, date, _, logmsg) = (self.svnlook("info") + "\n\n\n").split("\n", 3)
+        commit.author = author
+        commit.commit_date = date.partition('(')[0]
         commit.files = self.svnlook("dirs-changed").strip().replace("\n", " ")
-        commit.logmsg = self.svnlook("log").strip()
+        commit.logmsg = logmsg.strip()
         return commit
+    def commits(self, commit_ids):
+        "Generate Commit objects for a list of commit IDs."
+        for commit_id in commit_ids:
+            yield self.commit_factory(commit_id)
     def svnlook(self, info):
         return do("svnlook %s %s --revision %s" % (shellquote(info), shellquote(self.repository), shellquote(self.id)))
 
@@ -421,6 +618,7 @@ class HgExtractor(GenericExtractor):
         self.channels = unifromlocal(ui.config(b'irker', b'channels') or b'')
         self.email = unifromlocal(ui.config(b'irker', b'email') or b'')
         self.tcp = str(ui.configbool(b'irker', b'tcp'))  # converted to bool again in do_overrides
+        self.batch = str(ui.configbool(b'irker', b'batch'))
         self.template = unifromlocal(ui.config(b'irker', b'template') or b'')
         if not self.template:
             self.template = '%(bold)s%(project)s:%(reset)s %(green)s%(author)s%(reset)s %(repo)s:%(yellow)s%(branch)s%(reset)s * %(bold)s%(rev)s%(reset)s / %(bold)s%(files)s%(reset)s: %(logmsg)s %(brown)s%(url)s%(reset)s'
@@ -437,6 +635,9 @@ class HgExtractor(GenericExtractor):
                 + '/%s/rev/' % unifromlocal(self.repository.root).rstrip('/'))
         self.cialike = unifromlocal(ui.config(b'irker', b'cialike') or b'')
         self.filtercmd = unifromlocal(ui.config(b'irker', b'filtercmd') or b'')
+        self.filtermode = unifromlocal(ui.config(b'irker', b'filtermode') or b'') or self.filtermode
+        self.filtermodule = unifromlocal(ui.config(b'irker', b'filtermodule') or b'')
+        self.urlcache = unifromlocal(ui.config(b'irker', b'urlcache') or b'') or self.urlcache
         if not self.project:
             self.project = os.path.basename(unifromlocal(self.repository.root).rstrip('/'))
         self.do_overrides()
@@ -464,6 +665,10 @@ class HgExtractor(GenericExtractor):
         st = self.repository.status(ctx.p1().node(), ctx.node())
         commit.files = unifromlocal(b' '.join(st.modified + st.added + st.removed))
         return commit
+    def commits(self, commit_ids):
+        "Generate Commit objects for a list of commit IDs."
+        for commit_id in commit_ids:
+            yield self.commit_factory(commit_id)
 
 def hg_hook(ui, repo, **kwds):
     # To be called from a Mercurial "commit", "incoming" or "changegroup" hook.
@@ -476,8 +681,7 @@ def hg_hook(ui, repo, **kwds):
     if start != end:
         # changegroup with multiple commits, so we generate a notification
         # for each one
-        for rev in range(start, end):
-            ship(extractor, rev, False)
+        ship_commits(extractor, extractor.commits(range(start, end)), False)
     else:
         ship(extractor, kwds['node'], False)
 
@@ -492,20 +696,123 @@ def convert_message(message):
     """Convert the message to bytes to send to the socket"""
     return message.encode(locale.getlocale()[1] or 'UTF-8') + b'\n'
 
-def ship(extractor, commit, debug):
-    "Ship a notification for the specified commit."
-    metadata = extractor.commit_factory(commit)
-
-    # This is where we apply filtering
-    if extractor.filtercmd:
-        cmd = '%s %s' % (shellquote(extractor.filtercmd),
-                          shellquote(json.dumps(metadata.__dict__)))
-        data = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout.read()
+# irkerd reads datagrams of up to 8192 bytes
+UDP_BATCH_MAX = 8192
+
+class MetadataFilter:
+    "The filtermodule and filtercmd filters, set up once for a hook run."
+    def __init__(self, extractor):
+        self.function = None
+        self.command = extractor.filtercmd
+        self.mode = extractor.filtermode
+        self.coprocess = None
+        if extractor.filtermodule:
+            self.function = self.load(extractor.filtermodule)
+        if self.command and self.mode == "coprocess":
+            self.spawn()
+        elif self.command and self.mode != "command":
+            sys.stderr.write("irkerhook.py: unknown filtermode %s\n" % extractor.filtermode)
+            raise SystemExit(1)
+    @staticmethod
+    def load(name):
+        "Return the filter() function of a Python file or module."
+        import importlib
+        try:
+            if name.endswith(".py"):
+                import importlib.util
+                spec = importlib.util.spec_from_file_location("irker_filter", name)
+                module = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(module)
+            else:
+                module = importlib.import_module(name)
+            return module.filter
+        except (ImportError, IOError, OSError, AttributeError) as e:
+            sys.stderr.write("irkerhook.py: could not load filter %s: %s\n" % (name, e))
+            raise SystemExit(1)
+    def apply(self, metadata):
+        "Filter a commit's metadata in place."
+        if self.function is not None:
+            data = dict(metadata.__dict__)
+            result = self.function(data)
+            # The function may return new metadata or alter what it was given.
+            metadata.__dict__.update(data if result is None else result)
+        if self.command and self.mode == "coprocess":
+            if self.coprocess is None:
+                return
+            answer = self.ask(metadata)
+            if answer is None:
+                # Maybe it was a one-off; give it another chance.
+                self.spawn()
+                answer = self.ask(metadata)
+            if answer is None:
+                sys.stderr.write("irkerhook.py: filter %s keeps failing, "
+                                 "shipping commits unfiltered\n" % self.command)
+            else:
+                self.update(metadata, answer)
+        elif self.command:
+            cmd = '%s %s' % (shellquote(self.command),
+                              shellquote(json.dumps(metadata.__dict__)))
+            self.update(metadata, subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout.read())
+    @staticmethod
+    def update(metadata, data):
         try:
             metadata.__dict__.update(json.loads(data))
         except ValueError:
             sys.stderr.write("irkerhook.py: could not decode JSON: %s\n" % data)
             raise SystemExit(1)
+    def spawn(self):
+        "Start the filter coprocess."
+        # One filter process for the whole run, fed a line of JSON per
+        # commit and answering with a line of JSON.
+        self.coprocess = subprocess.Popen(self.command, shell=True,
+                                          stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE,
+                                          universal_newlines=True)
+    def ask(self, metadata):
+        "Pass metadata through the coprocess; its answer, or None if it died."
+        try:
+            self.coprocess.stdin.write(json.dumps(metadata.__dict__) + "\n")
+            self.coprocess.stdin.flush()
+            answer = self.coprocess.stdout.readline()
+        except (IOError, OSError, ValueError) as e:
+            sys.stderr.write("irkerhook.py: filter %s failed: %s\n"
+                             % (self.command, e))
+            answer = None
+        if not answer:
+            if answer is not None:
+                sys.stderr.write("irkerhook.py: filter %s quit answering\n"
+                                 % self.command)
+            # Whatever state it's in, we're done with it.
+            if self.coprocess.poll() is None:
+                self.coprocess.kill()
+            self.close()
+            return None
+        return answer
+    def close(self):
+        "Let the filter coprocess, if any, finish."
+        if self.coprocess is not None:
+            try:
+                self.coprocess.stdin.close()
+            except (IOError, OSError):
+                pass
+            self.coprocess.stdout.close()
+            self.coprocess.wait()
+            self.coprocess = None
+
+def notification(extractor, commit, metadata_filter=None):
+    "Return the irkerd request announcing a commit, by ID or Commit object."
+    if isinstance(commit, Commit):
+        metadata = commit
+    else:
+        metadata = extractor.commit_factory(commit)
+
+    # This is where we apply filtering
+    if metadata_filter is not None:
+        webview = metadata.webview()
+        metadata_filter.apply(metadata)
+        if metadata.webview() != webview:
+            # The filter pointed the URL elsewhere; look it up afresh.
+            metadata.url = None
 
     # Rewrite the file list if too long. The objective here is only
     # to be easier on the eyes.
@@ -536,42 +843,102 @@ def ship(extractor, commit, debug):
     if extractor.maxchannels != 0:
         channels = channels[:extractor.maxchannels]
 
-    # Ready to ship.
-    message = json.dumps({"to": channels, "privmsg": privmsg})
+    return {"to": channels, "privmsg": privmsg}
+
+def deliver(extractor, requests, debug):
+    "Ship irkerd requests together, over one connection."
     if debug:
-        print(message)
-    elif channels:
-        try:
-            if extractor.email:
-                # We can't really figure out what our SF username is without
-                # exploring our environment. The mail pipeline doesn't care
-                # about who sent the mail, other than being from sourceforge.
-                # A better way might be to simply call mail(1)
-                sender = "irker@users.sourceforge.net"
+        for request in requests:
+            print(json.dumps(request))
+        return
+    requests = [request for request in requests if request["to"]]
+    if not requests:
+        return
+    def batch(requests):
+        return convert_message(json.dumps(requests if len(requests) > 1 else requests[0]))
+    try:
+        if extractor.email:
+            # We can't really figure out what our SF username is without
+            # exploring our environment. The mail pipeline doesn't care
+            # about who sent the mail, other than being from sourceforge.
+            # A better way might be to simply call mail(1)
+            sender = "irker@users.sourceforge.net"
+            import smtplib
+            smtp = smtplib.SMTP()
+            smtp.connect()
+            for request in requests:
                 msg = """From: %(sender)s
 Subject: irker json
 
-%(message)s""" % {"sender":sender, "message":message}
-                import smtplib
-                smtp = smtplib.SMTP()
-                smtp.connect()
+%(message)s""" % {"sender":sender, "message":json.dumps(request)}
                 smtp.sendmail(sender, extractor.email, msg)
-                smtp.quit()
-            elif extractor.tcp:
-                try:
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.connect((extractor.server or default_server, IRKER_PORT))
-                    sock.sendall(convert_message(message))
-                finally:
-                    sock.close()
-            else:
-                try:
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                    sock.sendto(convert_message(message), (extractor.server or default_server, IRKER_PORT))
-                finally:
-                    sock.close()
-        except socket.error as e:
-            sys.stderr.write("%s\n" % e)
+            smtp.quit()
+        elif extractor.tcp:
+            try:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.connect((extractor.server or default_server, IRKER_PORT))
+                # A request per line, which any irkerd understands
+                sock.sendall(b"".join(batch([request]) for request in requests))
+            finally:
+                sock.close()
+        elif not extractor.batch:
+            try:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                for request in requests:
+                    sock.sendto(batch([request]), (extractor.server or default_server, IRKER_PORT))
+            finally:
+                sock.close()
+        else:
+            try:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                # As many requests to a datagram as irkerd will read
+                chunk = []
+                for request in requests:
+                    if chunk and len(batch(chunk + [request])) > UDP_BATCH_MAX:
+                        sock.sendto(batch(chunk), (extractor.server or default_server, IRKER_PORT))
+                        chunk = []
+                    chunk.append(request)
+                sock.sendto(batch(chunk), (extractor.server or default_server, IRKER_PORT))
+            finally:
+                sock.close()
+    except socket.error as e:
+        sys.stderr.write("%s\n" % e)
+
+def ship(extractor, commit, debug):
+    "Ship a notification for the specified commit, by ID or Commit object."
+    metadata_filter = MetadataFilter(extractor)
+    try:
+        request = notification(extractor, commit, metadata_filter)
+    finally:
+        metadata_filter.close()
+    deliver(extractor, [request], debug)
+
+def ship_commits(extractor, commits, debug):
+    "Ship notifications for a series of commits, in order, as one batch."
+    # Web view and tinyifier lookups are slow, so they are done
+    # concurrently for the whole series.
+    cache = None
+    if extractor.urlcache and extractor.urlcache.lower() != "none":
+        cache = URLCache(extractor.urlcache)
+    requests = []
+    metadata_filter = MetadataFilter(extractor)
+    try:
+        if ThreadPoolExecutor is None:
+            for commit in commits:
+                commit.resolve_url(cache)
+                requests.append(notification(extractor, commit, metadata_filter))
+        else:
+            with ThreadPoolExecutor(max_workers=URL_WORKERS) as pool:
+                pending = [(commit, pool.submit(commit.resolve_url, cache))
+                           for commit in commits]
+                for (commit, lookup) in pending:
+                    lookup.result()
+                    requests.append(notification(extractor, commit, metadata_filter))
+    finally:
+        metadata_filter.close()
+    if cache is not None:
+        cache.save()
+    deliver(extractor, requests, debug)
 
 if __name__ == "__main__":
     notify = True
@@ -601,8 +968,7 @@ if __name__ == "__main__":
     # And apply it.
     if not commits:
         commits = [extractor.head()]
-    for commit in commits:
-        ship(extractor, commit, not notify)
+    ship_commits(extractor, extractor.commits(commits), not notify)
 
 # The following sets edit modes for GNU EMACS
 # Local Variables: